@@ -1,13 +1,237 @@
+import io
+import os
+import resource
 import timeit
-from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import partial
+from itertools import islice
+from uuid import UUID, uuid4
 
-from django.core.management.base import BaseCommand
-from django.core.paginator import Paginator
-from memory_profiler import memory_usage, profile
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from django.db.models.base import ModelState
 
 from app.models import Ticket
 
 
+def get_batch_size(fields):
+    """Return how many rows to send per query, for queries with `fields` parameters per row
+
+    TICKET_BATCH_SIZE takes precedence. Otherwise the size is bounded by the maximum number
+    of query parameters of the backend (e.g. 999 on old SQLite), or 10000 for PostgreSQL
+    which has no such limit.
+    """
+    if settings.TICKET_BATCH_SIZE is not None:
+        if settings.TICKET_BATCH_SIZE < 1:
+            raise CommandError("TICKET_BATCH_SIZE must be a positive integer")
+        return settings.TICKET_BATCH_SIZE
+
+    max_query_params = connection.features.max_query_params
+    if max_query_params:
+        return max_query_params // fields
+    return 10000
+
+
+def random_token_buffer(n):
+    """Generate n random version 4 UUIDs as one contiguous buffer of 16*n bytes
+
+    The entropy is read with a single os.urandom call instead of one per uuid4(),
+    then the version and variant bits are set in place.
+    """
+    buf = bytearray(os.urandom(16 * n))
+    for i in range(0, 16 * n, 16):
+        buf[i + 6] = (buf[i + 6] & 0x0F) | 0x40
+        buf[i + 8] = (buf[i + 8] & 0x3F) | 0x80
+    return buf
+
+
+def new_tickets(n, chunk_size=1000):
+    """Lazily yield n unsaved Ticket instances
+
+    Tokens are sliced from one random buffer per chunk_size tickets, so only
+    one chunk is held in memory at a time.
+
+    Model.__init__ is skipped (field defaults, pre_init/post_init signals), the instances
+    only carry what bulk_create reads: the model state and the field attributes.
+    """
+    for offset in range(0, n, chunk_size):
+        size = min(chunk_size, n - offset)
+        buf = random_token_buffer(size)
+        for i in range(0, 16 * size, 16):
+            ticket = Ticket.__new__(Ticket)
+            ticket.__dict__.update(
+                _state=ModelState(),
+                id=None,
+                token=UUID(bytes=bytes(buf[i:i + 16])),
+            )
+            yield ticket
+
+
+@contextmanager
+def bulk_load():
+    """Run a bulk insert in a single transaction without waiting for the WAL to be flushed
+
+    Every batch would otherwise be committed, and fsynced, on its own. Losing the last
+    transactions on a crash is fine for sample data, the insert can simply be run again.
+
+    On PostgreSQL the table is analyzed once the load is committed, so the planner
+    statistics match the new rows without waiting for autoanalyze. Autovacuum is left
+    alone: it cannot see the rows before the commit anyway.
+    """
+    with transaction.atomic():
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL synchronous_commit = off")
+        yield
+
+    if connection.vendor == "postgresql":
+        table = connection.ops.quote_name(Ticket._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {table}")
+
+
+def update_tokens(ids, tokens):
+    """Update the tokens of many tickets with a single UPDATE ... FROM statement
+
+    Like the statement django-fast-update builds on PostgreSQL, the database joins the
+    new values against the primary key instead of evaluating a CASE WHEN branch per row
+    as bulk_update does.
+
+    `tokens` is a buffer of 16 bytes per id (see random_token_buffer). It is sent as a
+    single bytea parameter with the ids as a single array, and sliced by the database,
+    so no Python object is created per row.
+
+    Other backends fall back to bulk_update.
+    """
+    if not ids:
+        return
+
+    if connection.vendor != "postgresql":
+        tickets = [
+            Ticket(pk=pk, token=UUID(bytes=bytes(tokens[16 * i:16 * (i + 1)])))
+            for i, pk in enumerate(ids)
+        ]
+        Ticket.objects.bulk_update(tickets, ["token"], batch_size=len(ids))
+        return
+
+    table = connection.ops.quote_name(Ticket._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {table} AS t "
+            "SET token = encode(substring(%s::bytea FROM ((v.n - 1) * 16 + 1)::int FOR 16), 'hex')::uuid "
+            "FROM unnest(%s::bigint[]) WITH ORDINALITY AS v (id, n) WHERE t.id = v.id",
+            [tokens, ids],
+        )
+
+
+def split_id_range(min_id, max_id, parts):
+    """Split the ids from min_id to max_id into at most `parts` contiguous, non-overlapping ranges
+
+    Returns a list of (low, high) tuples, both bounds included.
+    """
+    size = -(-(max_id - min_id + 1) // parts)
+    return [
+        (low, min(low + size - 1, max_id))
+        for low in range(min_id, max_id + 1, size)
+    ]
+
+
+def parse_resume_point(content):
+    """Return the last updated id saved in error.log by regenerate_tokens_v3, saved as "id:<n>"
+
+    Returns None when there is nothing to resume. Raises ValueError when the content is not
+    a saved id, e.g. a page number left by the previous Paginator version.
+    """
+    content = content.strip()
+    if not content:
+        return None
+    if not content.startswith("id:"):
+        raise ValueError("{!r} is not a saved id".format(content))
+    try:
+        return int(content[3:])
+    except ValueError:
+        raise ValueError("{!r} is not a saved id".format(content))
+
+
+def regenerate_token_range(low, high):
+    """Regenerate the tokens of the tickets whose id is between low and high, in the database
+    """
+    table = connection.ops.quote_name(Ticket._meta.db_table)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} SET token = gen_random_uuid() WHERE id BETWEEN %s AND %s",
+                [low, high],
+            )
+    finally:
+        # each thread opens its own connection, close it before the thread is reused
+        connection.close()
+
+
+class Progress:
+    """Display the progress and the estimated remaining time of a job processed by batches
+
+    The status is written on a single line and only when the progress moved by `every`
+    percent, to avoid spending write/flush syscalls on cosmetic output.
+
+    The remaining time is estimated from an exponentially weighted moving average
+    of the time spent per item, with the clock only sampled once every `window` batches.
+    """
+
+    def __init__(self, stdout, total, done=0, every=1, window=10, alpha=0.1):
+        self.stdout = stdout
+        self.total = total
+        self.every = total * every / 100
+        self.window = window
+        self.alpha = alpha
+        self.batches = 0
+        self.average = None
+        self.timer = timeit.default_timer
+        self.reported_done = done
+        self.window_done = done
+        self.window_start = self.timer()
+
+    def step(self, done):
+        """Record a processed batch, `done` is the number of items processed so far
+        """
+        self.batches += 1
+        finished = done >= self.total
+        report = finished or done - self.reported_done >= self.every
+        if not report and self.batches % self.window:
+            return
+
+        # average the time per item since the last sample, then smooth it with the previous ones
+        now = self.timer()
+        processed = done - self.window_done
+        if processed > 0:
+            took = (now - self.window_start) / processed
+            if self.average is None:
+                self.average = took
+            else:
+                self.average = self.alpha * took + (1 - self.alpha) * self.average
+        self.window_start = now
+        self.window_done = done
+
+        if not report:
+            return
+        self.reported_done = done
+
+        # calculate progress and estimate remain time
+        # truncated rather than rounded, so 100.0% is only shown once the job is finished
+        progress = min(done * 1000 // self.total, 1000) / 10
+        remain_time = (self.total - done) * (self.average or 0)
+
+        # print out status
+        self.stdout.write(
+            f"\rProgress: {progress:.1f}% Remain: {remain_time:.0f}s",
+            ending="\n" if finished else "",
+        )
+        self.stdout.flush()
+
+
 class Command(BaseCommand):
     help = "Custom command manager to interact with Ticket table"
     
@@ -24,12 +248,29 @@ class Command(BaseCommand):
             action="store_true",
             help="Delete all data from Ticket table",
         )
+        parser.add_argument(
+            "--safe-delete",
+            action="store_true",
+            help="Delete through the ORM instead of TRUNCATE, so delete signals are sent",
+        )
         parser.add_argument(
             "-i2",
             "--insert2",
             action="store_true",
             help="[Optimized] Insert sample data to Ticket table",
         )
+        parser.add_argument(
+            "-i3",
+            "--insert3",
+            action="store_true",
+            help="[Optimized] Insert sample data to Ticket table using COPY",
+        )
+        parser.add_argument(
+            "-i4",
+            "--insert4",
+            action="store_true",
+            help="[Optimized] Insert sample data to Ticket table with a single server-side INSERT",
+        )
         parser.add_argument(
             "-r",
             "--regenerate",
@@ -46,83 +287,159 @@ class Command(BaseCommand):
             "-r3",
             "--regenerate3",
             action="store_true",
-            help="[Optimized] Regenerate all tokens of Ticket table using paginator",
+            help="[Optimized] Regenerate all tokens of Ticket table using keyset pagination",
+        )
+        parser.add_argument(
+            "-r4",
+            "--regenerate4",
+            action="store_true",
+            help="[Optimized] Regenerate all tokens of Ticket table with a single server-side UPDATE",
+        )
+        parser.add_argument(
+            "-r5",
+            "--regenerate5",
+            action="store_true",
+            help="[Optimized] Regenerate all tokens of Ticket table with parallel server-side UPDATEs",
+        )
+        parser.add_argument(
+            "-w",
+            "--workers",
+            type=int,
+            default=8,
+            help="Number of threads used by --regenerate5",
+        )
+        parser.add_argument(
+            "--profile",
+            action="store_true",
+            help="Measure the memory usage of the command with memory-profiler",
         )
         
     def handle(self, *args, **options):
         start = timeit.default_timer()
         
         if  options["delete"]:
-            memory = max(memory_usage(self.delete_tickets))
+            func = partial(self.delete_tickets, options["safe_delete"])
         
         elif options["insert"]:
-            memory = max(memory_usage(self.insert_tickets))
+            func = self.insert_tickets
 
         elif options["insert2"]:
-            memory = max(memory_usage(self.insert_tickets_v2))
+            func = self.insert_tickets_v2
+
+        elif options["insert3"]:
+            func = self.insert_tickets_v3
+
+        elif options["insert4"]:
+            func = self.insert_tickets_v4
             
         elif options["regenerate"]:
-            memory = max(memory_usage(self.regenerate_tokens))
+            func = self.regenerate_tokens
             
         elif options["regenerate2"]:
-            memory = max(memory_usage(self.regenerate_tokens_v2))
+            func = self.regenerate_tokens_v2
             
         elif options["regenerate3"]:
-            memory = max(memory_usage(self.regenerate_tokens_v3))
+            func = self.regenerate_tokens_v3
+
+        elif options["regenerate4"]:
+            func = self.regenerate_tokens_v4
+
+        elif options["regenerate5"]:
+            func = partial(self.regenerate_tokens_v5, options["workers"])
+
+        else:
+            raise CommandError("No action specified, see --help")
         
+        if options["profile"]:
+            # only import memory_profiler when needed, its sampler adds overhead
+            from memory_profiler import memory_usage
+
+            memory = max(memory_usage(func))
+        else:
+            func()
+            # peak resident set size of the process, reported in KiB on Linux
+            memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
         self.stdout.write("Memory usage: {:.4f} MiB".format(memory))
+
         self.stdout.write(
             self.style.SUCCESS("Took: {:.4f} sec".format(
                 timeit.default_timer() - start)
             )
         )
 
-    @profile
-    def delete_tickets(self):
+    def delete_tickets(self, safe=False):
         """Delete all data from Ticket table
+
+        TRUNCATE is used by default, the ORM delete is only needed if signals are ever added.
         """
-        Ticket.objects.all().delete()
+        if safe or connection.vendor not in ("postgresql", "mysql"):
+            Ticket.objects.all().delete()
+            return
+
+        table = connection.ops.quote_name(Ticket._meta.db_table)
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute(f"TRUNCATE TABLE {table} RESTART IDENTITY")
+            else:
+                cursor.execute(f"TRUNCATE TABLE {table}")
 
-    # @profile
     def insert_tickets(self):
         """The normal way to create batch of data
         """
-        data = [Ticket() for _ in range(1000000)]
-        Ticket.objects.bulk_create(data)
+        # split the INSERT into several statements instead of a single huge one
+        batch_size = get_batch_size(1)
+        Ticket.objects.bulk_create(new_tickets(1000000, batch_size), batch_size=batch_size)
 
-    # @profile
     def insert_tickets_v2(self):
         """The optimized version of insert_tickets to reduce the memory usage by generating smaller batch of data 
         """
-        display_remain_time = 999999
-        split_parts = 1000
-        for i in range(split_parts):
-            # start timer
-            start = timeit.default_timer()
-            
-            data = [Ticket() for _ in range(1000)]
-            Ticket.objects.bulk_create(data)
-            
-            # estimate remain time
-            took = timeit.default_timer() - start
-            estimated_remain_time = (split_parts - i) * took
-            # avoid the display_remain_time keep fluctuating too much
-            if estimated_remain_time < display_remain_time:
-                display_remain_time = estimated_remain_time
-            
-            # calculate progress
-            progress = (i + 1) / split_parts * 100
-                
-            # print out status
-            self.stdout.write(
-                "Progress: {:.1f}%".format(progress), ending=' '
-            )
-            self.stdout.write(
-                "Remain: {:.0f}s".format(display_remain_time), ending='\r'
+        total = 1000000
+        batch_size = get_batch_size(1)
+        progress = Progress(self.stdout, total)
+        tickets = new_tickets(total, batch_size)
+        with bulk_load():
+            for offset in range(0, total, batch_size):
+                size = min(batch_size, total - offset)
+                # bulk_create always turns its input into a list, so only
+                # pulling one batch per call keeps the memory usage low
+                Ticket.objects.bulk_create(islice(tickets, size), batch_size=batch_size)
+                progress.step(offset + size)
+
+    def insert_tickets_v3(self):
+        """The optimized version of insert_tickets that skips the ORM and streams rows with COPY
+        """
+        if connection.vendor != "postgresql":
+            raise CommandError("--insert3 requires PostgreSQL")
+
+        table = connection.ops.quote_name(Ticket._meta.db_table)
+        total = 1000000
+        batch_size = get_batch_size(1)
+        with bulk_load(), connection.cursor() as cursor:
+            for offset in range(0, total, batch_size):
+                size = min(batch_size, total - offset)
+                # PostgreSQL accepts 32 hex digits without hyphens as uuid input
+                buf = random_token_buffer(size)
+                rows = "".join(
+                    buf[i:i + 16].hex() + "\n" for i in range(0, 16 * size, 16)
+                )
+                cursor.copy_expert(f"COPY {table} (token) FROM STDIN", io.StringIO(rows))
+
+    def insert_tickets_v4(self):
+        """The optimized version of insert_tickets that lets the database generate the rows and tokens
+        """
+        if connection.vendor != "postgresql":
+            raise CommandError("--insert4 requires PostgreSQL")
+
+        # both columns are filled by their database defaults: the id sequence and
+        # gen_random_uuid() for the token (see migration 0004)
+        table = connection.ops.quote_name(Ticket._meta.db_table)
+        with bulk_load(), connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} SELECT FROM generate_series(1, %s)",
+                [1000000],
             )
-            self.stdout.flush()
 
-    # @profile
     def regenerate_tokens(self):
         """The normal way to update batch of data
         """
@@ -132,116 +449,117 @@ class Command(BaseCommand):
         
         Ticket.objects.bulk_update(tickets, ["token"])
 
-    # @profile
     def regenerate_tokens_v2(self):
         """The optimized version of regenerate_tokens to reduce the memory usage by using iterator
         """
-        display_remain_time = 999999
-
         total = Ticket.objects.count()
-        chunk_size = 1000
-        tickets = Ticket.objects.iterator(chunk_size=chunk_size)
+        progress = Progress(self.stdout, total)
+        chunk_size = get_batch_size(2)
+        # only fetch the primary keys, the old tokens are never read
+        pks = Ticket.objects.values_list("pk", flat=True).iterator(chunk_size=chunk_size)
         
-        chunk = []
-        for i, t in enumerate(tickets):
-            if i % chunk_size == 0:
-                # start timer
-                start = timeit.default_timer()
-            
-            t.token = uuid4()
-            chunk.append(t)
-
-            if (i+1) % chunk_size == 0:
-                # update data by chunk when chunk_size reaches 1000
-                Ticket.objects.bulk_update(chunk, ["token"])
-                chunk = []
-                
-                # estimate remain time
-                took = timeit.default_timer() - start
-                estimated_remain_time = (total - i) / chunk_size * took
-                # avoid the display_remain_time keep fluctuating too much
-                if estimated_remain_time < display_remain_time:
-                    display_remain_time = estimated_remain_time
-                
-                # calculate progress
-                progress = (i + 1) / total * 100
-                
-                # print out status
-                self.stdout.write(
-                    "Progress: {:.1f}%".format(progress), ending=" "
-                )
-                self.stdout.write(
-                    "Remain: {:.0f}s".format(display_remain_time), ending="\r"
-                )
-                self.stdout.flush()
+        done = 0
+        while True:
+            # pull exactly chunk_size ids, the last chunk may be smaller
+            chunk = list(islice(pks, chunk_size))
+            if not chunk:
+                break
 
-        # for remaining records if exist
-        if chunk:
-            Ticket.objects.bulk_update(chunk, ["token"])
+            update_tokens(chunk, random_token_buffer(len(chunk)))
+            done += len(chunk)
+            progress.step(done)
         
-    # @profile
     def regenerate_tokens_v3(self):
-        """The optimized version of regenerate_tokens to reduce the memory usage by using Paginator
+        """The optimized version of regenerate_tokens to reduce the memory usage by using keyset pagination
         """
         error_output = "./error.log"
-        current_page = 1
-        display_remain_time = 999999
+        chunk_size = get_batch_size(2)
+        last_id = 0
         
         # restart near the point of previous interruption
-        try:
-            # check if error output exist and get the current_page
+        if os.path.exists(error_output):
             with open(error_output) as f:
-                number = f.read()
-                current_page = int(number)
+                content = f.read()
+            try:
+                last_id = parse_resume_point(content) or 0
+            except ValueError as e:
+                self.stdout.write(
+                    self.style.WARNING("Ignoring {}: {}, starting over".format(error_output, e))
+                )
             
             # empty the error output
             with open(error_output, "w") as f:
                 f.write("")
-        except:
-            # if the error output does not exist or the data inside is not a number, then do nothing
-            pass
 
         try:
-            tickets = Ticket.objects.all()
-            paginator = Paginator(tickets, 1000)
-            
-            total_pages = paginator.num_pages
-            
-            for i in range(current_page, total_pages+1):
-                current_page = i
-                start = timeit.default_timer()
-                
-                page = paginator.page(i)
-                chunk = []
-                
-                for ticket in page.object_list:
-                    ticket.token = uuid4()
-                    chunk.append(ticket)
-            
-                Ticket.objects.bulk_update(chunk, ["token"])
-            
-                
-                # estimate remain time
-                took = timeit.default_timer() - start
-                estimated_remain_time = (total_pages - i + 1) * took
-                # avoid the display_remain_time keep fluctuating too much
-                if estimated_remain_time < display_remain_time:
-                    display_remain_time = estimated_remain_time
-
-                # calculate progress
-                progress = i / total_pages * 100
-                
-                # print out status
-                self.stdout.write(
-                    "Progress: {:.1f}%".format(progress), ending=' '
-                )
-                self.stdout.write(
-                    "Remain: {:.0f}s".format(display_remain_time), ending='\r'
+            # use the id range instead of COUNT(*) to calculate progress, both are read from the index
+            bounds = Ticket.objects.aggregate(min_id=Min("id"), max_id=Max("id"))
+            if bounds["max_id"] is None:
+                return
+            first_id = bounds["min_id"] - 1
+            max_id = bounds["max_id"]
+            progress = Progress(
+                self.stdout, max_id - first_id, done=max(last_id - first_id, 0)
+            )
+
+            while True:
+                # seek from the last updated id instead of using OFFSET,
+                # so every chunk is a range scan on the primary key index
+                pks = list(
+                    Ticket.objects.filter(id__gt=last_id)
+                    .order_by("id")
+                    .values_list("id", flat=True)[:chunk_size]
                 )
-                self.stdout.flush()
+                if not pks:
+                    break
+
+                update_tokens(pks, random_token_buffer(len(pks)))
+                last_id = pks[-1]
+                progress.step(last_id - first_id)
             
         except (Exception, KeyboardInterrupt) as e:
             self.stdout.write(self.style.ERROR(str(e)))
-            # write current_page to error output
+            # write last updated id to error output
             with open(error_output, "w") as f:
-                f.write(str(current_page))
+                f.write("id:{}".format(last_id))
+
+    def regenerate_tokens_v4(self):
+        """The optimized version of regenerate_tokens that lets the database generate the tokens
+        """
+        if connection.vendor != "postgresql":
+            raise CommandError("--regenerate4 requires PostgreSQL")
+
+        # gen_random_uuid() is built in since PostgreSQL 13, no Ticket is loaded into memory
+        table = connection.ops.quote_name(Ticket._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(f"UPDATE {table} SET token = gen_random_uuid()")
+
+    def regenerate_tokens_v5(self, workers):
+        """The optimized version of regenerate_tokens_v4 that updates non-overlapping id ranges in parallel
+        """
+        if connection.vendor != "postgresql":
+            raise CommandError("--regenerate5 requires PostgreSQL")
+        if workers < 1:
+            raise CommandError("--workers must be at least 1")
+
+        bounds = Ticket.objects.aggregate(min_id=Min("id"), max_id=Max("id"))
+        if bounds["max_id"] is None:
+            return
+        min_id = bounds["min_id"]
+        max_id = bounds["max_id"]
+
+        # split the id space into one range per worker
+        total = max_id - min_id + 1
+        ranges = split_id_range(min_id, max_id, workers)
+
+        progress = Progress(self.stdout, total, window=1)
+        done = 0
+        with ThreadPoolExecutor(workers) as executor:
+            futures = {
+                executor.submit(regenerate_token_range, low, high): high - low + 1
+                for low, high in ranges
+            }
+            for future in as_completed(futures):
+                future.result()
+                done += futures[future]
+                progress.step(done)
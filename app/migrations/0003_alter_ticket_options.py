@@ -0,0 +1,17 @@
+# Generated by Django 4.2.2 on 2026-10-15 09:00
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_alter_ticket_options'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='ticket',
+            options={},
+        ),
+    ]
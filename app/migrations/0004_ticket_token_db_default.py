@@ -0,0 +1,30 @@
+from django.db import migrations
+
+
+def set_token_default(apps, schema_editor):
+    # Django 4.2 has no Field.db_default, so the database default is set with raw SQL.
+    # gen_random_uuid() is built in since PostgreSQL 13, other backends keep no default.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Ticket = apps.get_model('app', 'Ticket')
+    table = schema_editor.quote_name(Ticket._meta.db_table)
+    schema_editor.execute(f'ALTER TABLE {table} ALTER COLUMN token SET DEFAULT gen_random_uuid()')
+
+
+def drop_token_default(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Ticket = apps.get_model('app', 'Ticket')
+    table = schema_editor.quote_name(Ticket._meta.db_table)
+    schema_editor.execute(f'ALTER TABLE {table} ALTER COLUMN token DROP DEFAULT')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_alter_ticket_options'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_token_default, drop_token_default),
+    ]
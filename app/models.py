@@ -4,8 +4,7 @@ from django.db import models
 
 
 class Ticket(models.Model):
+    # On PostgreSQL the column also has a database-only DEFAULT gen_random_uuid() (migration 0004),
+    # which `ticket --insert4` relies on. Django doesn't know about it, so any later AlterField
+    # on this column drops it and the migration has to set it again.
     token = models.UUIDField(default=uuid.uuid4)
-
-    class Meta:
-        # avoid UnorderedObjectListWarning when use Paginator
-        ordering = ['id']
@@ -1,3 +1,166 @@
-from django.test import TestCase
+import io
+import re
+import uuid
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.core.management.base import CommandError, OutputWrapper
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from app.management.commands.ticket import (
+    Progress,
+    get_batch_size,
+    parse_resume_point,
+    random_token_buffer,
+    split_id_range,
+    update_tokens,
+)
+from app.models import Ticket
+
+
+class GetBatchSizeTests(SimpleTestCase):
+    @override_settings(TICKET_BATCH_SIZE=500)
+    def test_setting_takes_precedence(self):
+        with mock.patch.object(connection.features, "max_query_params", 999):
+            self.assertEqual(get_batch_size(2), 500)
+
+    @override_settings(TICKET_BATCH_SIZE=0)
+    def test_setting_below_one(self):
+        with self.assertRaises(CommandError):
+            get_batch_size(1)
+
+    @override_settings(TICKET_BATCH_SIZE=None)
+    def test_max_query_params(self):
+        with mock.patch.object(connection.features, "max_query_params", 999):
+            self.assertEqual(get_batch_size(1), 999)
+            self.assertEqual(get_batch_size(2), 499)
+
+    @override_settings(TICKET_BATCH_SIZE=None)
+    def test_no_query_params_limit(self):
+        with mock.patch.object(connection.features, "max_query_params", None):
+            self.assertEqual(get_batch_size(2), 10000)
+
+
+class ParseResumePointTests(SimpleTestCase):
+    def test_saved_id(self):
+        self.assertEqual(parse_resume_point("id:4200"), 4200)
+        self.assertEqual(parse_resume_point("id:4200\n"), 4200)
+
+    def test_empty(self):
+        self.assertIsNone(parse_resume_point(""))
+        self.assertIsNone(parse_resume_point("\n"))
+
+    def test_legacy_page_number(self):
+        with self.assertRaises(ValueError):
+            parse_resume_point("200")
+
+    def test_malformed(self):
+        for content in ("id:abc", "id:", "last:12"):
+            with self.subTest(content=content):
+                with self.assertRaises(ValueError):
+                    parse_resume_point(content)
+
+
+class RandomTokenBufferTests(SimpleTestCase):
+    def test_length(self):
+        self.assertEqual(len(random_token_buffer(100)), 1600)
+
+    def test_version_and_variant_bits(self):
+        buf = random_token_buffer(1000)
+        for i in range(0, len(buf), 16):
+            token = uuid.UUID(bytes=bytes(buf[i:i + 16]))
+            self.assertEqual(token.version, 4)
+            self.assertEqual(token.variant, uuid.RFC_4122)
+
+
+class SplitIdRangeTests(SimpleTestCase):
+    def assertCovers(self, ranges, min_id, max_id, parts):
+        self.assertLessEqual(len(ranges), parts)
+        self.assertEqual(ranges[0][0], min_id)
+        self.assertEqual(ranges[-1][1], max_id)
+        for low, high in ranges:
+            self.assertLessEqual(low, high)
+        # each range starts right after the previous one: no gap and no overlap
+        for (_, previous_high), (low, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(low, previous_high + 1)
+
+    def test_split(self):
+        cases = [
+            (1, 1000000, 8),
+            (5, 17, 4),
+            (1, 3, 8),
+            (10, 10, 1),
+            (100, 199, 3),
+        ]
+        for min_id, max_id, parts in cases:
+            with self.subTest(min_id=min_id, max_id=max_id, parts=parts):
+                ranges = split_id_range(min_id, max_id, parts)
+                self.assertCovers(ranges, min_id, max_id, parts)
+
+    def test_even_split(self):
+        self.assertEqual(
+            split_id_range(1, 100, 4),
+            [(1, 25), (26, 50), (51, 75), (76, 100)],
+        )
+
+
+class ProgressTests(SimpleTestCase):
+    def reported(self, output):
+        return [float(value) for value in re.findall(r"Progress: ([\d.]+)%", output)]
+
+    def test_reports_every_percent(self):
+        out = io.StringIO()
+        progress = Progress(OutputWrapper(out), 1000)
+        for done in range(5, 1001, 5):
+            progress.step(done)
+
+        output = out.getvalue()
+        self.assertEqual(self.reported(output), [float(p) for p in range(1, 101)])
+        self.assertTrue(output.endswith("\n"))
+        self.assertEqual(output.count("\n"), 1)
+
+    def test_reports_completion(self):
+        out = io.StringIO()
+        progress = Progress(OutputWrapper(out), 1000, every=50)
+        for done in (300, 700, 1000):
+            progress.step(done)
+
+        output = out.getvalue()
+        self.assertEqual(self.reported(output), [70.0, 100.0])
+        self.assertTrue(output.endswith("\n"))
+
+    def test_truncates_before_completion(self):
+        out = io.StringIO()
+        progress = Progress(OutputWrapper(out), 1000000)
+        progress.step(999999)
+        self.assertEqual(self.reported(out.getvalue()), [99.9])
+
+        progress.step(1000000)
+        self.assertEqual(self.reported(out.getvalue()), [99.9, 100.0])
+
+    def test_resume(self):
+        out = io.StringIO()
+        progress = Progress(OutputWrapper(out), 100, done=50, every=10)
+        for done in range(51, 101):
+            progress.step(done)
+
+        self.assertEqual(self.reported(out.getvalue()), [60.0, 70.0, 80.0, 90.0, 100.0])
+
+
+@skipUnless(connection.vendor == "postgresql", "update_tokens slices the buffer with PostgreSQL-only SQL")
+class UpdateTokensTests(TestCase):
+    def test_each_id_gets_its_own_slice(self):
+        tickets = Ticket.objects.bulk_create(Ticket() for _ in range(50))
+        old_tokens = {ticket.pk: ticket.token for ticket in tickets}
+
+        # every other ticket, in reverse order, so the slices must follow the ids and not the table order
+        ids = [ticket.pk for ticket in tickets][::2][::-1]
+        buf = random_token_buffer(len(ids))
+        update_tokens(ids, buf)
+
+        tokens = dict(Ticket.objects.values_list("id", "token"))
+        for i, pk in enumerate(ids):
+            self.assertEqual(tokens[pk], uuid.UUID(bytes=bytes(buf[16 * i:16 * (i + 1)])))
+        for pk, token in old_tokens.items():
+            if pk not in ids:
+                self.assertEqual(tokens[pk], token)
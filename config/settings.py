@@ -13,6 +13,8 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 import os
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -126,3 +128,15 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Number of rows sent per query by the ticket command, computed from the database backend when unset
+
+TICKET_BATCH_SIZE = os.getenv("TICKET_BATCH_SIZE") or None
+if TICKET_BATCH_SIZE is not None:
+    try:
+        TICKET_BATCH_SIZE = int(TICKET_BATCH_SIZE)
+    except ValueError:
+        raise ImproperlyConfigured(
+            f"TICKET_BATCH_SIZE must be an integer, got {TICKET_BATCH_SIZE!r}"
+        )